@@ -1,13 +1,32 @@
 """
 Flask Application - Runs sync on a schedule
 """
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from flask_apscheduler import APScheduler
-from main import sync_mail_to_sheet
+from google.auth.transport import requests as google_requests
+from google.oauth2 import id_token
+from main import sync_mail_to_sheet, start_stale_ticket_worker
 from datetime import datetime
+import base64
+import json
+import os
+import queue
+import threading
+import time
 
 app = Flask(__name__)
 
+# Pub/Sub push configuration - when a topic is set, Gmail notifies us on new
+# mail and the scheduler only runs as a slow safety-net reconciliation
+GMAIL_PUBSUB_TOPIC = os.environ.get("GMAIL_PUBSUB_TOPIC")
+# Audience configured on the push subscription's OIDC token - pushes whose
+# bearer token doesn't verify against it are rejected
+GMAIL_PUBSUB_AUDIENCE = os.environ.get("GMAIL_PUBSUB_AUDIENCE")
+SYNC_INTERVAL_SECONDS = 300 if GMAIL_PUBSUB_TOPIC else 5
+
+# Pending sync requests, drained by a single worker thread
+sync_queue = queue.Queue()
+
 # Configure scheduler
 class Config:
     SCHEDULER_API_ENABLED = True
@@ -27,19 +46,146 @@ sync_status = {
 }
 
 
-@scheduler.task('interval', id='sync_job', seconds=5, misfire_grace_time=900)
-def scheduled_sync():
-    """Run sync every 5 seconds"""
-    global sync_status
+# Only one sync may ever run at a time - concurrent runs would duplicate
+# sheet rows and race on label changes
+_sync_lock = threading.Lock()
+
+# Consecutive syncs that found nothing - drives the idle polling backoff
+idle_ticks = 0
+MAX_POLL_INTERVAL = 300
+
+
+def run_sync():
+    """Run one sync and record its outcome (skips if one is already running)"""
+    global sync_status, idle_ticks
+    if not _sync_lock.acquire(blocking=False):
+        print("⏭️ Sync already running - skipping this trigger")
+        return
+
     try:
-        print(f"\n⏰ Scheduled sync triggered at {datetime.now()}")
-        sync_mail_to_sheet()
+        processed = sync_mail_to_sheet()
+        idle_ticks = 0 if processed else idle_ticks + 1
         sync_status["last_sync"] = datetime.now().isoformat()
         sync_status["last_error"] = None
         sync_status["sync_count"] += 1
     except Exception as e:
         sync_status["last_error"] = str(e)
         print(f"❌ Sync error: {e}")
+    finally:
+        _sync_lock.release()
+
+
+def sync_worker():
+    """Drain the sync queue - one sync at a time"""
+    while True:
+        sync_queue.get()
+
+        # Collapse any queued-up notifications into a single run
+        while not sync_queue.empty():
+            try:
+                sync_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        run_sync()
+
+
+# When the last poll was enqueued - ticks inside the backoff window are skipped
+_last_poll_at = 0.0
+
+
+@scheduler.task('interval', id='sync_job', seconds=SYNC_INTERVAL_SECONDS,
+                max_instances=1, coalesce=True, misfire_grace_time=30)
+def scheduled_sync():
+    """
+    Enqueue a sync on the polling interval (safety net when push is enabled)
+    Quiet periods stretch the effective interval exponentially up to
+    MAX_POLL_INTERVAL; any sync that finds mail resets it
+    """
+    global _last_poll_at
+
+    backoff = min(MAX_POLL_INTERVAL, SYNC_INTERVAL_SECONDS * 2 ** min(idle_ticks, 6))
+    now = time.time()
+    if now - _last_poll_at < backoff:
+        return
+
+    _last_poll_at = now
+    print(f"\n⏰ Scheduled sync triggered at {datetime.now()}")
+    sync_queue.put({})
+
+
+def register_gmail_watch():
+    """(Re)register the Gmail push watch on the configured topic"""
+    from gmail_handler import new_gmail_service, start_gmail_watch
+    start_gmail_watch(new_gmail_service(), GMAIL_PUBSUB_TOPIC)
+    print(f"📡 Gmail watch registered on {GMAIL_PUBSUB_TOPIC}")
+
+
+@scheduler.task('interval', id='watch_renewal_job', hours=24,
+                max_instances=1, coalesce=True)
+def renew_gmail_watch():
+    """Gmail watches expire after ~7 days - re-register daily to keep push alive"""
+    if not GMAIL_PUBSUB_TOPIC:
+        return
+    try:
+        register_gmail_watch()
+    except Exception as e:
+        print(f"⚠️ Gmail watch renewal failed: {e}")
+
+
+# Highest historyId seen from push notifications - Pub/Sub may deliver a
+# notification more than once, and duplicates need not trigger a sync
+_last_pushed_history_id = 0
+
+# Shared transport for verifying push tokens (caches Google's signing certs)
+_token_request = google_requests.Request()
+
+
+def _verify_pubsub_token():
+    """
+    Validate the OIDC bearer token Pub/Sub attaches to push deliveries
+    Returns: True when the token verifies (signature, issuer and - when
+    GMAIL_PUBSUB_AUDIENCE is set - audience)
+    """
+    auth = request.headers.get("Authorization", "")
+    if not auth.startswith("Bearer "):
+        return False
+    try:
+        id_token.verify_oauth2_token(
+            auth[len("Bearer "):], _token_request, audience=GMAIL_PUBSUB_AUDIENCE
+        )
+        return True
+    except ValueError:
+        return False
+
+
+def _notification_history_id(envelope):
+    """Decode the historyId from a Pub/Sub push envelope, or None"""
+    try:
+        payload = json.loads(base64.b64decode(envelope["message"]["data"]))
+        return int(payload["historyId"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+@app.route('/pubsub', methods=['POST'])
+def pubsub_push():
+    """Gmail push notification endpoint - enqueue a sync and return fast"""
+    global _last_pushed_history_id
+
+    # Anyone can POST to this URL - only act on pushes Google actually signed
+    if not _verify_pubsub_token():
+        return "", 403
+
+    hid = _notification_history_id(request.get_json(silent=True) or {})
+    if hid is not None:
+        if hid <= _last_pushed_history_id:
+            # Redelivered or out-of-order notification - already synced
+            return "", 204
+        _last_pushed_history_id = hid
+
+    sync_queue.put({})
+    return "", 204
 
 
 @app.route('/')
@@ -82,8 +228,19 @@ def status():
 if __name__ == '__main__':
     print("🚀 Starting Flask application with scheduler...")
     print("📱 Access the app at: http://localhost:5000")
-    print("🔄 Sync will run automatically every 5 seconds")
-    
+    print(f"🔄 Sync will run automatically every {SYNC_INTERVAL_SECONDS} seconds")
+
+    # Start the sync worker thread
+    threading.Thread(target=sync_worker, daemon=True).start()
+
+    # Stale-ticket scans run on their own timer thread, off the sync path
+    start_stale_ticket_worker()
+
+    # Register Gmail push notifications when a Pub/Sub topic is configured
+    # (the watch_renewal_job re-registers daily once the scheduler runs)
+    if GMAIL_PUBSUB_TOPIC:
+        register_gmail_watch()
+
     # Start scheduler
     scheduler.start()
     
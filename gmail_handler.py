@@ -3,10 +3,16 @@ Gmail Handler - Manages all Gmail API operations
 """
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import google_auth_httplib2
+import httplib2
 import os
-import pickle
 import re
+import time
 
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
@@ -14,13 +20,22 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.modify",
 ]
 
+TOKEN_FILE = "token.json"
+LEGACY_TOKEN_FILE = "token.pickle"
+
 
 def get_gmail_credentials():
     """Authenticate and return Gmail credentials"""
     creds = None
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as f:
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    elif os.path.exists(LEGACY_TOKEN_FILE):
+        # One-time migration from the old pickle token store
+        import pickle
+        with open(LEGACY_TOKEN_FILE, "rb") as f:
             creds = pickle.load(f)
+        with open(TOKEN_FILE, "w") as f:
+            f.write(creds.to_json())
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -31,26 +46,63 @@ def get_gmail_credentials():
             )
             creds = flow.run_local_server(port=0)
 
-        with open("token.pickle", "wb") as f:
-            pickle.dump(creds, f)
+        with open(TOKEN_FILE, "w") as f:
+            f.write(creds.to_json())
     return creds
 
 
+# Cached Gmail service - its authorized transport keeps TCP/TLS connections
+# alive across calls instead of paying a handshake per request
+_gmail_service = None
+
+
 def get_gmail_service():
-    """Build and return Gmail service"""
-    creds = get_gmail_credentials()
-    return build("gmail", "v1", credentials=creds)
+    """Build and return Gmail service (shared keep-alive transport)"""
+    global _gmail_service
+    if _gmail_service is None:
+        creds = get_gmail_credentials()
+        authed_http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        _gmail_service = build("gmail", "v1", http=authed_http)
+    return _gmail_service
+
+
+def new_gmail_service():
+    """
+    Build a Gmail service on a transport of its own
+    For worker threads - the cached service's transport must not be shared
+    """
+    return build("gmail", "v1", http=_fresh_authorized_http())
+
+
+def refresh_credentials_if_needed(creds):
+    """Refresh OAuth credentials in place if they have expired"""
+    if creds and creds.expired and creds.refresh_token:
+        creds.refresh(Request())
 
 
 def get_my_email(gmail):
     """Get the authenticated user's email address"""
-    return gmail.users().getProfile(userId="me").execute()["emailAddress"].lower()
+    profile = gmail.users().getProfile(userId="me", fields="emailAddress").execute()
+    return profile["emailAddress"].lower()
+
+
+# Compiled once at import - both run for every message processed
+_EMAIL_RE = re.compile(r"<([^>]+)>")
+_NOREPLY_RE = re.compile(
+    r"^(noreply|no[-_]?reply|donotreply|do[-_]?not[-_]?reply|notifications?"
+    r"|automat(ed|ion)|mailer|daemon|bounces?)@",
+    re.I
+)
 
 
 def extract_email(value):
     """Extract email address from string like 'Name <email@example.com>'"""
-    m = re.search(r"<(.+?)>", value)
-    return m.group(1).lower() if m else value.lower()
+    i = value.find("<")
+    if i < 0:
+        # Bare address with no display name - nothing to parse
+        return value.lower()
+    m = _EMAIL_RE.search(value, i)
+    return (m.group(1) if m else value).lower()
 
 
 def is_noreply_email(email):
@@ -58,41 +110,26 @@ def is_noreply_email(email):
     Check if email is a no-reply address
     Returns: True if it's a no-reply email
     """
-    email_lower = email.lower()
-    
-    # Common no-reply patterns
-    noreply_patterns = [
-        "noreply@",
-        "no-reply@",
-        "no_reply@",
-        "donotreply@",
-        "do-not-reply@",
-        "do_not_reply@",
-        "notifications@",
-        "notification@",
-        "automated@",
-        "automation@",
-        "mailer@",
-        "daemon@",
-        "bounce@",
-        "bounces@"
-    ]
-    
-    # Check if email starts with any no-reply pattern
-    for pattern in noreply_patterns:
-        if email_lower.startswith(pattern):
-            return True
-    
-    return False
+    return bool(_NOREPLY_RE.match(email))
+
+
+# Label IDs never change for the life of the process - resolve each name once
+_LABEL_CACHE = {}
 
 
 def get_or_create_label(gmail, name):
-    """Get existing label or create new one"""
-    labels = gmail.users().labels().list(userId="me").execute()["labels"]
+    """Get existing label or create new one (memoized by name)"""
+    if name in _LABEL_CACHE:
+        return _LABEL_CACHE[name]
+
+    labels = gmail.users().labels().list(
+        userId="me", fields="labels(id,name)"
+    ).execute()["labels"]
     for label in labels:
         if label["name"] == name:
+            _LABEL_CACHE[name] = label["id"]
             return label["id"]
-    
+
     # Create label if it doesn't exist
     label_object = {
         "name": name,
@@ -100,6 +137,7 @@ def get_or_create_label(gmail, name):
         "messageListVisibility": "show"
     }
     created = gmail.users().labels().create(userId="me", body=label_object).execute()
+    _LABEL_CACHE[name] = created["id"]
     return created["id"]
 
 
@@ -113,7 +151,8 @@ def fetch_all_threads(gmail, query):
             userId="me",
             q=query,
             maxResults=100,
-            pageToken=token
+            pageToken=token,
+            fields="threads(id,historyId),nextPageToken"
         ).execute()
         
         threads.extend(response.get("threads", []))
@@ -125,32 +164,223 @@ def fetch_all_threads(gmail, query):
     return threads
 
 
-def get_thread_details(gmail, thread_id):
-    """Get full thread details including all messages"""
-    return gmail.users().threads().get(userId="me", id=thread_id).execute()
+def start_gmail_watch(gmail, topic_name):
+    """
+    Register a Gmail push notification watch on the INBOX
+    Notifications are delivered to the given Cloud Pub/Sub topic
+    Watches expire after ~7 days, so callers must re-register regularly
+    Returns: the historyId the watch starts from
+    """
+    body = {
+        "topicName": topic_name,
+        "labelIds": ["INBOX"]
+    }
+    response = gmail.users().watch(userId="me", body=body).execute()
+
+    expiration_ms = int(response.get("expiration", 0))
+    if expiration_ms:
+        print(f"📡 Gmail watch active until {datetime.fromtimestamp(expiration_ms / 1000)}")
+
+    return int(response["historyId"])
+
+
+def get_start_history_id(gmail):
+    """Seed a history cursor from the user's profile"""
+    profile = gmail.users().getProfile(userId="me", fields="historyId").execute()
+    return int(profile["historyId"])
+
+
+def list_history_thread_ids(gmail, start_history_id):
+    """
+    List thread IDs touched since start_history_id via the History API
+    Returns: (thread_ids, new_history_id), or (None, None) when the
+    cursor has expired and the caller must fall back to a full query
+    """
+    thread_ids = []
+    new_history_id = start_history_id
+    token = None
+
+    while True:
+        try:
+            response = gmail.users().history().list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded", "labelAdded"],
+                pageToken=token,
+                fields="history/messagesAdded/message/threadId,"
+                       "historyId,nextPageToken"
+            ).execute()
+        except HttpError as e:
+            # 404 means the history cursor is too old to resume from
+            if e.resp.status == 404:
+                return None, None
+            raise
+
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                tid = added.get("message", {}).get("threadId")
+                if tid:
+                    thread_ids.append(tid)
+
+        new_history_id = int(response.get("historyId", new_history_id))
+        token = response.get("nextPageToken")
+
+        if not token:
+            break
+
+    return thread_ids, new_history_id
+
+
+def _execute_batch_with_backoff(batch, http=None, retries=4):
+    """Execute a batch request, backing off exponentially on rate limits"""
+    delay = 1
+    for attempt in range(retries):
+        try:
+            batch.execute(http=http)
+            return
+        except HttpError as e:
+            if e.resp.status not in (429, 500, 502, 503) or attempt == retries - 1:
+                raise
+            print(f"⚠️ Gmail batch got HTTP {e.resp.status}, retrying in {delay}s")
+            time.sleep(delay)
+            delay *= 2
+
+
+def _fresh_authorized_http():
+    """A transport of its own per worker - httplib2 objects are not thread-safe"""
+    return google_auth_httplib2.AuthorizedHttp(get_gmail_credentials(), http=httplib2.Http())
+
+
+def fetch_threads_metadata_batch(gmail, thread_ids, retries=4):
+    """
+    Fetch metadata for many threads in batched HTTP requests
+    Only the From/Subject headers are requested (format=metadata)
+    Multiple 100-thread chunks are fetched concurrently, and sub-requests
+    that fail individually (per-item rate limits) are retried with backoff
+    Returns: dict mapping thread_id to thread resource
+    """
+    results = {}
+
+    def _fetch_round(ids):
+        """One batched pass over ids - returns the ids whose fetch failed"""
+        failed = []
+
+        def _collect(request_id, response, exception):
+            if exception is not None:
+                failed.append(request_id)
+                return
+            results[request_id] = response
+
+        # Gmail allows at most 100 sub-requests per batch
+        batches = []
+        for start in range(0, len(ids), 100):
+            chunk = ids[start:start + 100]
+            batch = gmail.new_batch_http_request(callback=_collect)
+            for tid in chunk:
+                batch.add(
+                    gmail.users().threads().get(
+                        userId="me",
+                        id=tid,
+                        format="metadata",
+                        metadataHeaders=["From", "Subject"],
+                        fields="id,messages(id,internalDate,labelIds,payload/headers)"
+                    ),
+                    request_id=tid
+                )
+            batches.append(batch)
+
+        if len(batches) <= 1:
+            for batch in batches:
+                _execute_batch_with_backoff(batch)
+        else:
+            # Overlap the chunk round trips; each worker gets its own transport
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                list(pool.map(
+                    lambda b: _execute_batch_with_backoff(b, http=_fresh_authorized_http()),
+                    batches
+                ))
+
+        return failed
+
+    pending = list(thread_ids)
+    delay = 1
+    for attempt in range(retries):
+        pending = _fetch_round(pending)
+        if not pending:
+            break
+        if attempt < retries - 1:
+            print(f"⚠️ Retrying {len(pending)} failed thread fetch(es) in {delay}s")
+            time.sleep(delay)
+            delay *= 2
+
+    for tid in pending:
+        print(f"⚠️ Batch fetch failed for thread {tid} after {retries} attempts")
+
+    return results
+
+
+# The only headers the sync logic ever reads
+_WANTED_HEADERS = ("from", "subject")
 
 
 def get_last_message(thread):
-    """Get the most recent message in the thread"""
+    """
+    Get the most recent message in the thread
+    Returns: (message, headers) where headers holds only the
+    From/Subject values keyed by lowercase name
+    """
     if not thread.get("messages"):
         return None, None
-    
-    last_msg = max(thread["messages"], key=lambda x: int(x["internalDate"]))
-    headers = {x["name"]: x["value"] for x in last_msg["payload"]["headers"]}
-    
+
+    # Gmail returns thread messages oldest-first - the last one is newest
+    last_msg = thread["messages"][-1]
+
+    headers = {}
+    for h in last_msg["payload"]["headers"]:
+        name = h["name"].lower()
+        if name in _WANTED_HEADERS:
+            headers[name] = h["value"]
+            if len(headers) == len(_WANTED_HEADERS):
+                break
+
     return last_msg, headers
 
 
-def update_thread_labels(gmail, thread_id, add_labels=None, remove_labels=None):
-    """Update labels on a thread"""
+def batch_trash_threads(gmail, thread_ids):
+    """Move many threads to trash in batched HTTP requests"""
+    def _report(request_id, response, exception):
+        if exception is not None:
+            print(f"⚠️ Could not trash thread {request_id}: {exception}")
+
+    for start in range(0, len(thread_ids), 100):
+        batch = gmail.new_batch_http_request(callback=_report)
+        for tid in thread_ids[start:start + 100]:
+            batch.add(gmail.users().threads().trash(userId="me", id=tid), request_id=tid)
+        batch.execute()
+
+
+def batch_modify_threads(gmail, thread_ids, add_labels=None, remove_labels=None):
+    """
+    Apply the same label change to many threads in batched HTTP requests
+    """
+    if not thread_ids:
+        return
+
     body = {}
     if add_labels:
         body["addLabelIds"] = add_labels
     if remove_labels:
         body["removeLabelIds"] = remove_labels
-    
-    gmail.users().threads().modify(
-        userId="me",
-        id=thread_id,
-        body=body
-    ).execute()
+
+    def _report(request_id, response, exception):
+        if exception is not None:
+            print(f"⚠️ Could not update labels on thread {request_id}: {exception}")
+
+    for start in range(0, len(thread_ids), 100):
+        batch = gmail.new_batch_http_request(callback=_report)
+        for tid in thread_ids[start:start + 100]:
+            batch.add(
+                gmail.users().threads().modify(userId="me", id=tid, body=body),
+                request_id=tid
+            )
+        batch.execute()
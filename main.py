@@ -2,38 +2,50 @@
 Main Sync Logic - Combines Gmail and Sheets operations
 """
 import os
+import re
+import sqlite3
+import threading
 import time
+from datetime import datetime
 from gmail_handler import (
     get_gmail_service,
+    new_gmail_service,
     get_gmail_credentials,
+    refresh_credentials_if_needed,
     get_my_email,
     extract_email,
     is_noreply_email,
     get_or_create_label,
     fetch_all_threads,
-    get_thread_details,
+    fetch_threads_metadata_batch,
+    get_start_history_id,
+    list_history_thread_ids,
     get_last_message,
-    update_thread_labels
+    batch_modify_threads,
+    batch_trash_threads
 )
 from sheets_handler import (
     get_sheets_client,
     open_spreadsheet,
     get_worksheet,
     get_all_tickets,
-    get_next_ticket_id,
+    allocate_ticket_ids,
     create_ticket_row,
-    add_new_ticket,
-    update_existing_ticket,
+    append_tickets,
+    batch_update_tickets,
+    ensure_link_formula,
+    batch_get_ranges,
+    delete_rows_batch,
     initialize_state_sheets,
     get_last_sync_timestamp,
     save_last_sync_timestamp,
-    load_thread_state_from_sheet,
     save_thread_state_to_sheet
 )
 
 # ================= CONFIG =================
 SPREADSHEET_ID = "1F1STl7ubwviajSvu1LGfw6FGiDUQJbcZ-fI586pqwiE"
-THREAD_STATE_FILE = "thread_state.txt"
+THREAD_STATE_DB = "thread_state.db"
+LEGACY_THREAD_STATE_FILE = "thread_state.txt"  # migrated into the db once
 SHEET_BACKUP_INTERVAL = 50  # Backup to sheet every 50 syncs
 TICKET_MAP_REFRESH_INTERVAL = 20  # Refresh ticket map every 20 syncs
 
@@ -42,15 +54,31 @@ AUTO_CLOSE_ENABLED = True  # Set to False to disable auto-close
 AUTO_CLOSE_HOURS = 6  # Close tickets after N hours of no customer response
 AUTO_CLOSE_ACTION = "close"  # Options: "close" (mark as closed) or "delete" (remove from sheet and trash email)
 
+# No-reply handling: when False, no-reply senders are skipped before any
+# Sheets or Gmail write; when True, they are logged as closed tickets
+LOG_NOREPLY_TICKETS = False
+
+# Optional Bloom filter for sender membership - a few bits per sender instead
+# of a full Python set entry. A false positive only mis-flags a genuinely new
+# sender as known (column G says "No" once too often), never breaks a ticket
+try:
+    from pybloom_live import ScalableBloomFilter
+except ImportError:
+    ScalableBloomFilter = None
+
+SENDER_FILTER_CAPACITY = 100_000
+SENDER_FILTER_ERROR_RATE = 0.001
+
 # Admin email addresses - Add ALL your email addresses here
-ADMIN_EMAILS = [
+# A set gives O(1) membership checks in the sync loop
+ADMIN_EMAILS = {
     "support-ticketana@he5.in"
     # Add your email addresses here (lowercase)
     # Example:
     # "admin@example.com",
     # "support@example.com",
     # "sales@example.com",
-]
+}
 
 # Global counters and cache
 sync_counter = 0
@@ -58,29 +86,161 @@ cached_thread_map = None
 last_ticket_map_refresh = 0
 sheets_initialized = False
 
+# Cached clients and labels - network-expensive to build, invariant across syncs
+cached_creds = None
+cached_gmail = None
+cached_sheet = None
+cached_main_worksheet = None
+cached_labels = None
+cached_my_email = None
+
+# History API cursor - lets each sync fetch only the delta since the last one
+last_history_id = None
+
+# Profile historyId from the previous sync - when it hasn't moved, the whole
+# sync can be skipped for the price of one tiny getProfile call
+last_profile_history_id = None
+
 # New sender tracking
 known_senders = set()
 known_senders_loaded = False
 
+# Tickets currently awaiting a customer reply: thread_id -> epoch seconds
+# Seeded from the sheet on the first stale scan, then kept current by the
+# sync loop so later scans need zero network calls
+stale_candidates = None
+
+# Guards stale_candidates - it is shared between the sync loop and the
+# background stale-ticket worker
+stale_lock = threading.Lock()
+
+# Serializes whole sync cycles against the stale-ticket scan: the scan
+# deletes sheet rows and invalidates cached_thread_map, which must never
+# happen while a sync is reading the map or holding row numbers to write
+sync_lock = threading.Lock()
 
-# ================= FILE-BASED STATE MANAGEMENT =================
-def load_thread_state_from_file():
-    """Load thread processing state from file"""
-    state = {}
-    if os.path.exists(THREAD_STATE_FILE):
-        with open(THREAD_STATE_FILE, "r") as f:
-            for line in f:
-                if "|" in line:
-                    tid, ts = line.strip().split("|")
-                    state[tid] = int(ts)
-    return state
+# Interval between background stale-ticket scans (seconds)
+STALE_CHECK_INTERVAL = 100
 
+_stale_worker_started = False
 
-def save_thread_state_to_file(state):
-    """Save thread processing state to file"""
-    with open(THREAD_STATE_FILE, "w") as f:
-        for tid, ts in state.items():
-            f.write(f"{tid}|{ts}\n")
+
+# ================= SQLITE STATE MANAGEMENT =================
+# Thread IDs whose state changed since the last save - only these rows
+# are upserted into the database, instead of rewriting everything each sync
+dirty_thread_ids = set()
+
+# Pre-mark timestamps of the dirty threads, so a failed flush can undo the
+# marks and the next sync retries those threads instead of skipping them
+_dirty_undo = {}
+
+# Open connection and in-memory copies of the table - all built once
+_state_conn = None
+_thread_state_cache = None
+_thread_history_cache = None
+
+
+def get_state_db():
+    """
+    Open the SQLite thread-state store (once per process)
+    WAL mode keeps writes from blocking reads; the old thread_state.txt
+    log is migrated into the table the first time the db is created
+    """
+    global _state_conn
+    if _state_conn is None:
+        fresh = not os.path.exists(THREAD_STATE_DB)
+        conn = sqlite3.connect(THREAD_STATE_DB, isolation_level=None)
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "CREATE TABLE IF NOT EXISTS thread_state"
+            "(thread_id TEXT PRIMARY KEY, ts INTEGER, history_id INTEGER);"
+            "CREATE TABLE IF NOT EXISTS sync_meta"
+            "(key TEXT PRIMARY KEY, value TEXT);"
+        )
+        # Databases created before the history_id column need it added
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(thread_state)")]
+        if "history_id" not in columns:
+            conn.execute("ALTER TABLE thread_state ADD COLUMN history_id INTEGER")
+        if fresh and os.path.exists(LEGACY_THREAD_STATE_FILE):
+            # One-time migration from the old append-log format
+            legacy = {}
+            with open(LEGACY_THREAD_STATE_FILE, "r") as f:
+                for line in f.read().splitlines():
+                    if "|" in line:
+                        tid, ts = line.split("|")
+                        legacy[tid] = int(ts)
+            conn.executemany(
+                "INSERT OR REPLACE INTO thread_state(thread_id, ts) VALUES (?, ?)",
+                legacy.items(),
+            )
+            print(f"💾 Migrated {len(legacy)} thread state entries to SQLite")
+        _state_conn = conn
+    return _state_conn
+
+
+def load_thread_state():
+    """
+    Thread state dict - read from SQLite once, then kept current in memory
+    by mark_thread_processed
+    """
+    global _thread_state_cache, _thread_history_cache
+    if _thread_state_cache is None:
+        rows = get_state_db().execute(
+            "SELECT thread_id, ts, history_id FROM thread_state"
+        ).fetchall()
+        _thread_state_cache = {tid: ts for tid, ts, _ in rows}
+        _thread_history_cache = {tid: hid for tid, _, hid in rows if hid}
+    return _thread_state_cache
+
+
+def mark_thread_processed(state, tid, ts, history_id=None):
+    """Record a processed thread and flag it for the next state save"""
+    if tid not in dirty_thread_ids:
+        _dirty_undo[tid] = state.get(tid)
+        dirty_thread_ids.add(tid)
+    state[tid] = ts
+    if history_id:
+        _thread_history_cache[tid] = history_id
+
+
+def rollback_processed_marks(state):
+    """
+    Undo this cycle's processed marks after a failed flush
+    Restores each dirty thread's previous timestamp so the next sync
+    picks the thread up again instead of treating it as done
+    """
+    for tid, previous_ts in _dirty_undo.items():
+        if previous_ts is None:
+            state.pop(tid, None)
+        else:
+            state[tid] = previous_ts
+    _dirty_undo.clear()
+    dirty_thread_ids.clear()
+
+
+def save_thread_state_to_db(state, dirty_tids):
+    """Upsert only the changed entries - O(dirty), not O(all threads)"""
+    get_state_db().executemany(
+        "INSERT OR REPLACE INTO thread_state VALUES (?, ?, ?)",
+        [(tid, state[tid], _thread_history_cache.get(tid)) for tid in dirty_tids],
+    )
+
+
+def load_saved_history_id():
+    """History cursor persisted by the previous process, or None"""
+    row = get_state_db().execute(
+        "SELECT value FROM sync_meta WHERE key = 'history_id'"
+    ).fetchone()
+    return int(row[0]) if row else None
+
+
+def save_history_id(history_id):
+    """Persist the history cursor so a restart can resume the delta fetch"""
+    get_state_db().execute(
+        "INSERT OR REPLACE INTO sync_meta VALUES ('history_id', ?)",
+        (str(history_id),),
+    )
 
 
 def is_admin_email(email):
@@ -89,44 +249,33 @@ def is_admin_email(email):
     return email_lower in ADMIN_EMAILS
 
 
-def load_admin_emails_from_sheet(sheet):
+def new_sender_store():
     """
-    Load admin emails from Admin emails sheet
-    Returns: list of admin email addresses
+    Container for known sender addresses
+    A Bloom filter when pybloom-live is installed, a plain set otherwise -
+    both support add() and the `in` operator
     """
-    try:
-        admin_sheet = sheet.worksheet("Admin emails")
-        rows = admin_sheet.get_all_values()
-        
-        admin_emails = []
-        # Skip header row (row 1)
-        for row in rows[1:]:
-            if len(row) > 0 and row[0]:  # If column A has a value
-                email = row[0].strip().lower()  # Clean and lowercase
-                if email:  # If not empty after stripping
-                    admin_emails.append(email)
-        
-        print(f"📧 Loaded {len(admin_emails)} admin emails from sheet: {', '.join(admin_emails)}")
-        return admin_emails
-    except Exception as e:
-        print(f"⚠️ Could not load Admin emails sheet: {e}")
-        print(f"⚠️ Using hardcoded ADMIN_EMAILS instead")
-        return []
+    if ScalableBloomFilter is not None:
+        return ScalableBloomFilter(
+            initial_capacity=SENDER_FILTER_CAPACITY,
+            error_rate=SENDER_FILTER_ERROR_RATE,
+        )
+    return set()
 
 
 def load_known_senders(main_worksheet):
     """
-    Load all unique sender emails from the sheet into a set
-    Returns: set of email addresses
+    Load all unique sender emails from the sheet into the sender store
+    Reads only the sender column instead of the whole sheet
+    Returns: sender store (Bloom filter or set)
     """
-    all_rows = main_worksheet.get_all_values()
-    senders = set()
-    
-    # Column D (index 3) contains email addresses
-    for row in all_rows[1:]:  # Skip header
-        if len(row) > 3 and row[3]:
-            senders.add(row[3].lower())
-    
+    # Column D contains email addresses
+    rows = main_worksheet.get_values("D2:D")
+    senders = new_sender_store()
+    for row in rows:
+        if row and row[0]:
+            senders.add(row[0].lower())
+
     print(f"📧 Loaded {len(senders)} known senders from sheet")
     return senders
 
@@ -134,10 +283,15 @@ def load_known_senders(main_worksheet):
 def is_new_sender_cached(from_email):
     """
     Check if sender is new using cached set
+    from_email must already be lowercase (extract_email lowercases)
     Returns: True if new, False if seen before
     """
     global known_senders
-    return from_email.lower() not in known_senders
+    return from_email not in known_senders
+
+
+# Matches the "YYYY-MM-DD HH:MM:SS" timestamps written to column C
+_TS_RE = re.compile(r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)")
 
 
 def check_and_close_stale_tickets(gmail, sheet, main_worksheet):
@@ -149,60 +303,106 @@ def check_and_close_stale_tickets(gmail, sheet, main_worksheet):
         return
     
     print(f"\n🔍 Checking for stale tickets (>{AUTO_CLOSE_HOURS}h no customer response)...")
-    
-    # Get all tickets
-    all_rows = main_worksheet.get_all_values()
+
+    global stale_candidates, cached_thread_map
+
+    # Snapshot the map - the sync thread may swap it while we scan. Without a
+    # map (no successful sync yet, or a rebuild is pending) candidates cannot
+    # be told apart from deleted tickets, so keep them and try again later
+    thread_map = cached_thread_map
+    if thread_map is None:
+        print("   ⏭️ Ticket map not ready - skipping stale scan")
+        return
+
     current_time = int(time.time())
-    closed_count = 0
-    deleted_count = 0
-    
-    for i, row in enumerate(all_rows[1:], start=2):  # Skip header
-        if len(row) < 6:
-            continue
-            
-        ticket_id = row[0]
-        thread_id = row[1]
-        timestamp_str = row[2]
-        status = row[5]
-        
-        # Only check tickets awaiting customer reply
-        if status != "Awaiting customer reply":
-            continue
-        
-        # Parse timestamp
-        try:
-            from datetime import datetime
-            ticket_time = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-            ticket_timestamp = int(ticket_time.timestamp())
-        except:
-            continue
-        
-        # Check if ticket is older than AUTO_CLOSE_HOURS
-        hours_passed = (current_time - ticket_timestamp) / 3600
-        
-        if hours_passed >= AUTO_CLOSE_HOURS:
+
+    to_close = []   # Row numbers to mark closed
+    to_delete = []  # (row_number, thread_id) pairs to remove
+
+    with stale_lock:
+        if stale_candidates is None:
+            # First scan: seed the index from the sheet (one narrow read);
+            # afterwards the sync loop keeps it current in memory
+            rows = main_worksheet.get_values("A2:F")
+            stale_candidates = {}
+            for row in rows:
+                if len(row) >= 6 and row[5] == "Awaiting customer reply":
+                    m = _TS_RE.match(row[2])
+                    if m:
+                        stale_candidates[row[1]] = int(datetime(*map(int, m.groups())).timestamp())
+            print(f"   📋 Seeded stale-ticket index: {len(stale_candidates)} candidate(s)")
+
+        for tid, ticket_timestamp in list(stale_candidates.items()):
+            # Check if ticket is older than AUTO_CLOSE_HOURS
+            hours_passed = (current_time - ticket_timestamp) / 3600
+            if hours_passed < AUTO_CLOSE_HOURS:
+                continue
+
+            entry = thread_map.get(tid)
+            if not entry:
+                # Ticket genuinely gone from the sheet - drop the candidate
+                stale_candidates.pop(tid, None)
+                continue
+
+            row_num, ticket_id = entry
             if AUTO_CLOSE_ACTION == "delete":
-                # Delete from sheet
-                main_worksheet.delete_rows(i)
-                print(f"   🗑️ Deleted ticket {ticket_id} (no response for {hours_passed:.1f}h)")
-                
-                # Trash the email thread
-                try:
-                    gmail.users().threads().trash(userId="me", id=thread_id).execute()
-                    print(f"   📧 Trashed email thread {thread_id}")
-                except Exception as e:
-                    print(f"   ⚠️ Could not trash thread: {e}")
-                
-                deleted_count += 1
+                to_delete.append((row_num, tid))
+                print(f"   🗑️ Deleting ticket {ticket_id} (no response for {hours_passed:.1f}h)")
             else:  # "close"
-                # Update status to Closed
-                row[5] = "Closed - No customer response"
-                main_worksheet.update(f"A{i}:H{i}", [row], value_input_option="USER_ENTERED")
-                print(f"   ✅ Closed ticket {ticket_id} (no response for {hours_passed:.1f}h)")
-                closed_count += 1
-    
-    if closed_count > 0 or deleted_count > 0:
-        print(f"📊 Auto-close summary: {closed_count} closed, {deleted_count} deleted")
+                to_close.append(row_num)
+                print(f"   ✅ Closing ticket {ticket_id} (no response for {hours_passed:.1f}h)")
+            stale_candidates.pop(tid, None)
+
+    # One values.batchUpdate closes every stale ticket
+    if to_close:
+        batch_update_tickets(main_worksheet, [
+            {"range": f"F{i}", "values": [["Closed - No customer response"]]}
+            for i in to_close
+        ])
+
+    # One batchUpdate removes all rows, one batched request trashes the threads
+    if to_delete:
+        delete_rows_batch(sheet, main_worksheet, [i for i, _ in to_delete])
+        batch_trash_threads(gmail, [tid for _, tid in to_delete])
+
+        # Row numbers shifted - force a thread-map rebuild on the next sync
+        cached_thread_map = None
+
+    if to_close or to_delete:
+        print(f"📊 Auto-close summary: {len(to_close)} closed, {len(to_delete)} deleted")
+
+
+def start_stale_ticket_worker():
+    """
+    Run the stale-ticket scan on its own timer thread so it never adds
+    latency to the sync loop
+    The worker builds its own Gmail and Sheets clients - the cached ones
+    belong to the sync thread and their transports are not thread-safe
+    """
+    global _stale_worker_started
+    if _stale_worker_started or not AUTO_CLOSE_ENABLED:
+        return
+    _stale_worker_started = True
+
+    def _worker():
+        creds = get_gmail_credentials()
+        gmail = new_gmail_service()
+        sheet = open_spreadsheet(get_sheets_client(creds), SPREADSHEET_ID)
+        main_worksheet = get_worksheet(sheet, "Email log")
+
+        while True:
+            time.sleep(STALE_CHECK_INTERVAL)
+            try:
+                refresh_credentials_if_needed(creds)
+                # Never scan while a sync is mid-flight - row deletions would
+                # shift the rows its buffered updates point at
+                with sync_lock:
+                    check_and_close_stale_tickets(gmail, sheet, main_worksheet)
+            except Exception as e:
+                print(f"⚠️ Stale-ticket worker error: {e}")
+
+    threading.Thread(target=_worker, daemon=True).start()
+    print(f"🧹 Stale-ticket worker started (every {STALE_CHECK_INTERVAL}s)")
 
 
 # ================= MAIN SYNC FUNCTION =================
@@ -210,41 +410,73 @@ def sync_mail_to_sheet():
     """
     Main synchronization function
     Syncs Gmail threads with Google Sheets ticket system
+    Returns: number of threads examined this cycle (0 when idle)
     """
+    # Whole cycles hold sync_lock so the stale-ticket worker can never
+    # delete rows or invalidate the ticket map while a sync is in flight
+    with sync_lock:
+        return _sync_cycle()
+
+
+def _sync_cycle():
+    """One sync cycle - caller must hold sync_lock"""
     print("\n" + "="*50)
     print("Starting sync...")
     print("="*50)
     
-    # Initialize Gmail
-    gmail = get_gmail_service()
-    my_email = get_my_email(gmail)
-    
-    # Auto-add authenticated email to admin list if not already there
-    global ADMIN_EMAILS
-    if my_email not in ADMIN_EMAILS:
-        ADMIN_EMAILS.append(my_email)
-    
-    print(f"📧 Authenticated as: {my_email}")
-    print(f"👥 Admin emails: {', '.join(ADMIN_EMAILS)}")
+    # Initialize clients ONCE and reuse them across syncs
+    global cached_creds, cached_gmail, cached_sheet, cached_main_worksheet
+    if cached_gmail is None:
+        cached_creds = get_gmail_credentials()
+        cached_gmail = get_gmail_service()
+        gc = get_sheets_client(cached_creds)
+        cached_sheet = open_spreadsheet(gc, SPREADSHEET_ID)
+        cached_main_worksheet = get_worksheet(cached_sheet, "Email log")
+        print(f"📊 Connected to spreadsheet")
+    else:
+        refresh_credentials_if_needed(cached_creds)
+
+    gmail = cached_gmail
+    sheet = cached_sheet
+    main_worksheet = cached_main_worksheet
+
+    # Cheapest idle check: if the mailbox historyId hasn't advanced since the
+    # last sync, nothing changed and the whole cycle can be skipped.
+    # Recorded only once the cycle completes - recording it here would make
+    # the next tick skip the retry after a failed cycle
+    global last_profile_history_id
+    profile_history_id = get_start_history_id(gmail)
+    if profile_history_id == last_profile_history_id:
+        print("⏭️ Mailbox unchanged since last sync - skipping")
+        return 0
+
+    # Ask Gmail "who am I?" only once per process
+    global cached_my_email, ADMIN_EMAILS
+    if cached_my_email is None:
+        cached_my_email = get_my_email(gmail)
+        ADMIN_EMAILS.add(cached_my_email)
+        print(f"📧 Authenticated as: {cached_my_email}")
+    my_email = cached_my_email
 
-    # Initialize Sheets
-    creds = get_gmail_credentials()
-    gc = get_sheets_client(creds)
-    sheet = open_spreadsheet(gc, SPREADSHEET_ID)
-    main_worksheet = get_worksheet(sheet, "Email log")
-    print(f"📊 Connected to spreadsheet")
+    print(f"👥 Admin emails: {', '.join(ADMIN_EMAILS)}")
 
     # Initialize state sheets ONCE (only on first run)
     global sheets_initialized
     if not sheets_initialized:
         initialize_state_sheets(sheet)
+        ensure_link_formula(main_worksheet)
         sheets_initialized = True
 
-    # Get or create labels
-    admin_label = get_or_create_label(gmail, "Awaiting_Admin_Reply")
-    cust_label = get_or_create_label(gmail, "Awaiting_Customer_Reply")
-    noreply_label = get_or_create_label(gmail, "No_Reply_Mail")
-    print(f"🏷️ Labels configured")
+    # Get or create labels ONCE - label IDs never change for the process lifetime
+    global cached_labels
+    if cached_labels is None:
+        cached_labels = (
+            get_or_create_label(gmail, "Awaiting_Admin_Reply"),
+            get_or_create_label(gmail, "Awaiting_Customer_Reply"),
+            get_or_create_label(gmail, "No_Reply_Mail"),
+        )
+        print(f"🏷️ Labels configured")
+    admin_label, cust_label, noreply_label = cached_labels
 
     # Get existing tickets (cached - refresh periodically)
     global cached_thread_map, last_ticket_map_refresh, sync_counter
@@ -257,14 +489,31 @@ def sync_mail_to_sheet():
     else:
         print(f"📋 Using cached ticket map: {len(cached_thread_map)} existing tickets")
     
-    # Load known senders (once per run)
+    # Load admin emails and known senders ONCE, in a single batched read
     global known_senders, known_senders_loaded
     if not known_senders_loaded:
-        known_senders = load_known_senders(main_worksheet)
+        try:
+            admin_rows, sender_rows = batch_get_ranges(
+                sheet, ["'Admin emails'!A2:A", "'Email log'!D2:D"]
+            )
+            for row in admin_rows:
+                email = row[0].strip().lower() if row else ""
+                if email:
+                    ADMIN_EMAILS.add(email)
+            known_senders = new_sender_store()
+            for row in sender_rows:
+                if row and row[0]:
+                    known_senders.add(row[0].lower())
+            print(f"📧 Loaded {len(ADMIN_EMAILS)} admin email(s) and "
+                  f"{len(known_senders)} known sender(s) in one batched read")
+        except Exception as e:
+            print(f"⚠️ Could not batch-load admin emails: {e}")
+            print(f"⚠️ Using hardcoded ADMIN_EMAILS instead")
+            known_senders = load_known_senders(main_worksheet)
         known_senders_loaded = True
     
-    # Load thread state from FILE (fast, no API calls)
-    thread_state = load_thread_state_from_file()
+    # Load thread state from SQLite (fast, no API calls, cached after first run)
+    thread_state = load_thread_state()
     
     # Get last sync from sheet ONLY on first run, then use file
     if sync_counter == 1:
@@ -276,31 +525,98 @@ def sync_mail_to_sheet():
     
     print(f"📊 Loaded state: {len(thread_state)} threads tracked (sync #{sync_counter})")
     
-    # Build query
-    query = f"after:{last_sync}" if last_sync else "newer_than:7d"
-    
-    # Fetch threads
-    threads = fetch_all_threads(gmail, query)
+    # Fetch only the delta via the History API when we have a cursor.
+    # The advanced cursor is held in next_history_id and only committed after
+    # this sync's writes succeed - committing it up front would permanently
+    # skip the delta if anything later in the cycle failed
+    global last_history_id
+    threads = None
+    if last_history_id is None:
+        # Resume the cursor saved by the previous process, if any
+        last_history_id = load_saved_history_id()
+    next_history_id = last_history_id
+    if last_history_id is not None:
+        changed_tids, new_history_id = list_history_thread_ids(gmail, last_history_id)
+        if changed_tids is not None:
+            threads = [{"id": tid} for tid in changed_tids]
+            next_history_id = new_history_id
+            print(f"📊 History delta: {len(threads)} thread event(s) since last sync")
+
+    if threads is None:
+        # First run (or expired history cursor) - fall back to a full query.
+        # No -from: exclusions here: Gmail matches queries at thread level,
+        # so excluding admin senders would also drop customer threads the
+        # admin replied to and their missed replies would never be fetched.
+        # Admin-initiated threads are skipped cheaply in the loop instead
+        query = f"after:{last_sync}" if last_sync else "newer_than:7d"
+        threads = fetch_all_threads(gmail, query)
+        # Seed the cursor from the profile id fetched at the top of this sync
+        next_history_id = profile_history_id
     
     # CRITICAL: Deduplicate threads (Gmail sometimes returns duplicates)
-    seen_thread_ids = set()
-    unique_threads = []
-    for thread in threads:
-        tid = thread["id"]
-        if tid not in seen_thread_ids:
-            seen_thread_ids.add(tid)
-            unique_threads.append(thread)
-    
-    if len(threads) != len(unique_threads):
-        print(f"⚠️ Removed {len(threads) - len(unique_threads)} duplicate thread(s)")
-    
-    threads = unique_threads
+    # One C-level dict build, insertion order preserved
+    before = len(threads)
+    threads = list({t["id"]: t for t in threads}.values())
+
+    if before != len(threads):
+        print(f"⚠️ Removed {before - len(threads)} duplicate thread(s)")
+
+    # Threads whose listed historyId matches the one stored when they were
+    # last processed cannot have changed - drop them before paying for their
+    # metadata (only the query fallback lists historyId; deltas are bare ids)
+    unfiltered = len(threads)
+    threads = [
+        t for t in threads
+        if "historyId" not in t
+        or int(t["historyId"]) != _thread_history_cache.get(t["id"])
+    ]
+    if unfiltered != len(threads):
+        print(f"⏭️ Skipped {unfiltered - len(threads)} unchanged thread(s) by historyId")
+
     print(f"📬 Found {len(threads)} threads to process\n")
 
+    # Fetch all thread metadata in one batched request (instead of N round trips)
+    thread_details = fetch_threads_metadata_batch(gmail, [t["id"] for t in threads])
+
+    # Pre-pass: count the genuinely new tickets so their IDs can be reserved
+    # in one Ticket_Config read+write instead of a pair of calls per ticket.
+    # Mirrors the skip logic of the main loop below
+    new_ticket_count = 0
+    for thread_info in threads:
+        tid = thread_info["id"]
+        if tid in cached_thread_map:
+            continue
+        thread = thread_details.get(tid)
+        if not thread:
+            continue
+        msg, headers = get_last_message(thread)
+        if not msg or int(msg["internalDate"]) // 1000 <= thread_state.get(tid, 0):
+            continue
+        from_email = extract_email(headers.get("from", ""))
+        if is_noreply_email(from_email):
+            if LOG_NOREPLY_TICKETS:
+                new_ticket_count += 1
+        elif from_email not in ADMIN_EMAILS:
+            new_ticket_count += 1
+
+    ticket_id_pool = iter(allocate_ticket_ids(sheet, new_ticket_count))
+
+    # Accumulate sheet writes and flush them in batched calls after the loop
+    row_updates = []
+    new_rows = []
+
+    # Thread IDs bucketed by label change, flushed in batched calls
+    to_admin_reply = []
+    to_cust_reply = []
+    to_noreply = []
+
     # Process each thread
     for thread_info in threads:
         tid = thread_info["id"]
-        
+        # historyId as listed, stored with the state so the next backfill can
+        # skip this thread if it hasn't moved
+        listed_history_id = int(thread_info["historyId"]) if "historyId" in thread_info else None
+
         print(f"\n{'='*60}")
         print(f"🔍 DEBUG: Examining thread {tid}")
         print(f"   In cached_thread_map: {tid in cached_thread_map}")
@@ -309,8 +625,12 @@ def sync_mail_to_sheet():
             print(f"   Thread_state timestamp: {thread_state[tid]}")
         print(f"{'='*60}")
         
-        # Get full thread details
-        thread = get_thread_details(gmail, tid)
+        # Get thread details (pre-fetched in the batch above)
+        thread = thread_details.get(tid)
+        if not thread:
+            print(f"⏭️ Skipping thread {tid} - batch fetch failed")
+            continue
+
         msg, headers = get_last_message(thread)
         
         if not msg:
@@ -324,8 +644,11 @@ def sync_mail_to_sheet():
             print(f"⏭️ Skipping thread {tid} - already processed")
             continue
 
-        from_email = extract_email(headers.get("From", ""))
-        subject = headers.get("Subject", "No Subject")
+        from_email = extract_email(headers.get("from", ""))
+        subject = headers.get("subject", "No Subject")
+
+        # extract_email already lowercased - test admin membership once, reuse
+        is_admin = from_email in ADMIN_EMAILS
 
         print(f"\n📨 Processing thread {tid}")
         print(f"   From: {from_email}")
@@ -336,6 +659,12 @@ def sync_mail_to_sheet():
         if is_noreply:
             print(f"   🚫 NO-REPLY EMAIL DETECTED: {from_email}")
 
+        # Short-circuit no-reply senders before any Sheets/Gmail write
+        if is_noreply and not LOG_NOREPLY_TICKETS:
+            print(f"   ⏭️ Skipping no-reply sender")
+            mark_thread_processed(thread_state, tid, ts, listed_history_id)
+            continue
+
         # Determine if new or existing ticket
         is_new_ticket = tid not in cached_thread_map
         
@@ -351,90 +680,83 @@ def sync_mail_to_sheet():
         # SPECIAL HANDLING FOR NO-REPLY EMAILS
         if is_noreply and is_new_ticket:
             print(f"   🚫 Processing no-reply email as closed ticket")
-            
-            # FINAL SAFETY CHECK: Re-check cache one more time
-            final_check_map = get_all_tickets(main_worksheet)
-            if tid in final_check_map:
-                print(f"   ⚠️ WARNING: Thread {tid} was just created by another process!")
-                print(f"   ⏭️ Skipping to avoid duplicate")
-                cached_thread_map = final_check_map
-                thread_state[tid] = ts
-                continue
-            
-            # Generate ticket ID
-            ticket_id = get_next_ticket_id(sheet)
+
+            # Take the next preallocated ticket ID
+            ticket_id = next(ticket_id_pool)
             print(f"   🎫 New no-reply ticket: {ticket_id}")
             
             # Create ticket with special status
             status = "No-reply - Closed"
             row_data = create_ticket_row(ticket_id, tid, from_email, subject, status, new_sender=False)
             
-            # Add ticket to sheet
-            add_new_ticket(main_worksheet, row_data)
+            # Queue ticket row for the batched append
+            new_rows.append(row_data)
             print(f"   ✅ Created no-reply ticket {ticket_id}")
-            
-            # Add no-reply label to Gmail
-            update_thread_labels(gmail, tid, [noreply_label], [admin_label, cust_label])
-            print(f"   🏷️ Added 'No_Reply_Mail' label to thread")
-            
+
+            # Queue no-reply label change for the batched modify (skip when
+            # the thread is already labelled correctly)
+            current_labels = set(msg.get("labelIds", ()))
+            if (noreply_label not in current_labels
+                    or admin_label in current_labels
+                    or cust_label in current_labels):
+                to_noreply.append(tid)
+                print(f"   🏷️ Queued 'No_Reply_Mail' label for thread")
+
             # Mark as processed and stop thread
-            thread_state[tid] = ts
-            
-            # Update cache
-            cached_thread_map = get_all_tickets(main_worksheet)
+            mark_thread_processed(thread_state, tid, ts, listed_history_id)
             print(f"   🛑 Thread stopped - no further updates will be processed")
             continue
         
         # Skip if no-reply email on existing ticket (shouldn't happen, but safety check)
         if is_noreply and not is_new_ticket:
             print(f"   ⏭️ Skipping - no-reply email on existing ticket")
-            thread_state[tid] = ts
+            mark_thread_processed(thread_state, tid, ts, listed_history_id)
             continue
         
         # Skip NEW threads initiated by admin
-        if is_new_ticket and is_admin_email(from_email):
+        if is_new_ticket and is_admin:
             print(f"   ⏭️ Skipping - admin-initiated thread")
-            thread_state[tid] = ts
+            mark_thread_processed(thread_state, tid, ts, listed_history_id)
             continue
 
         if not is_new_ticket:
-            # Existing ticket - get ticket ID
-            row_num = cached_thread_map[tid]
-            ticket_data = main_worksheet.row_values(row_num)
-            ticket_id = ticket_data[0]
+            # Existing ticket - row and ticket ID are already cached
+            row_num, ticket_id = cached_thread_map[tid]
         else:
-            # New ticket - generate ticket ID
-            
-            # FINAL SAFETY CHECK: Re-check cache one more time
-            # (in case another process created it)
-            final_check_map = get_all_tickets(main_worksheet)
-            if tid in final_check_map:
-                print(f"   ⚠️ WARNING: Thread {tid} was just created by another process!")
-                print(f"   ⏭️ Skipping to avoid duplicate")
-                cached_thread_map = final_check_map  # Update cache
-                continue
-            
-            ticket_id = get_next_ticket_id(sheet)
+            # New ticket - take the next preallocated ticket ID
+            ticket_id = next(ticket_id_pool)
             print(f"   🎫 New ticket: {ticket_id}")
             print(f"   🆔 DEBUG: Full thread ID = {tid}")
             print(f"   🆔 DEBUG: Thread ID length = {len(tid)}")
             
             # CRITICAL: Mark as processed BEFORE creating ticket
             # This prevents duplicate creation if thread appears again in same batch
-            thread_state[tid] = ts
+            mark_thread_processed(thread_state, tid, ts, listed_history_id)
             print(f"   ✅ DEBUG: Marked {tid} as processed with timestamp {ts}")
 
         # Determine status based on last sender
-        if is_admin_email(from_email):
+        if is_admin:
             status = "Awaiting customer reply"
         else:
             status = "Awaiting admin reply"
 
-        # Update Gmail labels
-        labels_to_add = [admin_label] if status == "Awaiting admin reply" else [cust_label]
-        labels_to_remove = [cust_label] if status == "Awaiting admin reply" else [admin_label]
-        
-        update_thread_labels(gmail, tid, labels_to_add, labels_to_remove)
+        # Keep the stale-ticket index current (saves the scan a sheet read)
+        with stale_lock:
+            if stale_candidates is not None:
+                if status == "Awaiting customer reply":
+                    stale_candidates[tid] = int(time.time())
+                else:
+                    stale_candidates.pop(tid, None)
+
+        # Queue Gmail label change for the batched modify - but only when the
+        # thread isn't already labelled correctly (steady-state revisits are)
+        current_labels = set(msg.get("labelIds", ()))
+        if status == "Awaiting admin reply":
+            if admin_label not in current_labels or cust_label in current_labels:
+                to_admin_reply.append(tid)
+        else:
+            if cust_label not in current_labels or admin_label in current_labels:
+                to_cust_reply.append(tid)
 
         # Check if new sender (only for new tickets)
         new_sender = False
@@ -442,7 +764,7 @@ def sync_mail_to_sheet():
             new_sender = is_new_sender_cached(from_email)
             if new_sender:
                 print(f"   🆕 NEW SENDER: {from_email}")
-                known_senders.add(from_email.lower())  # Add to cache
+                known_senders.add(from_email)  # Add to cache (already lowercase)
             else:
                 print(f"   👤 Known sender: {from_email}")
 
@@ -450,37 +772,74 @@ def sync_mail_to_sheet():
         row_data = create_ticket_row(ticket_id, tid, from_email, subject, status, new_sender)
 
         if not is_new_ticket:
-            # Update existing ticket
-            update_existing_ticket(main_worksheet, row_num, row_data)
+            # Queue update for the batched values.batchUpdate
+            row_updates.append({"range": f"A{row_num}:G{row_num}", "values": [row_data]})
             print(f"   ✅ Updated ticket {ticket_id}")
         else:
-            # Create new ticket
-            add_new_ticket(main_worksheet, row_data)
+            # Queue new ticket row for the batched append
+            new_rows.append(row_data)
             print(f"   ✅ Created ticket {ticket_id}")
-            
-            # IMPORTANT: Refresh the cached thread map immediately after creating a new ticket
-            # This prevents duplicate ticket creation if the same thread is processed again
-            cached_thread_map = get_all_tickets(main_worksheet)
-            print(f"   🔄 Refreshed cache to include new ticket")
 
         # Mark as processed (update timestamp)
-        thread_state[tid] = ts
+        mark_thread_processed(thread_state, tid, ts, listed_history_id)
 
-    # Save thread state to FILE (always - fast, no API quota)
-    if threads:
-        save_thread_state_to_file(thread_state)
-        print(f"💾 Saved thread state to file")
-    
-    # Backup to sheet every N syncs (reduce API calls)
+    # Flush the accumulated changes. If any flush fails, this cycle's
+    # processed marks are rolled back so the next sync retries these threads
+    # instead of skipping tickets whose rows were never written
+    try:
+        # Label changes - one batched request per bucket instead of one call per thread
+        batch_modify_threads(gmail, to_admin_reply, [admin_label], [cust_label])
+        batch_modify_threads(gmail, to_cust_reply, [cust_label], [admin_label])
+        batch_modify_threads(gmail, to_noreply, [noreply_label], [admin_label, cust_label])
+
+        # Sheet writes - one batched call per kind
+        if row_updates:
+            batch_update_tickets(main_worksheet, row_updates)
+            print(f"📊 Applied {len(row_updates)} ticket update(s) in one batched call")
+        if new_rows:
+            response = append_tickets(main_worksheet, new_rows)
+            print(f"📊 Appended {len(new_rows)} new ticket(s) in one call")
+
+            # Extend the cached map from where the API says the rows landed,
+            # instead of assuming they went to max(map row)+1
+            try:
+                updated_range = response["updates"]["updatedRange"]
+                start_cell = updated_range.split("!")[1].split(":")[0]
+                next_row = int(re.search(r"\d+", start_cell).group())
+                for row_data in new_rows:
+                    cached_thread_map[row_data[1]] = (next_row, row_data[0])
+                    next_row += 1
+            except (KeyError, TypeError, AttributeError, IndexError):
+                # Can't tell where the rows landed - rebuild the map next sync
+                print(f"⚠️ Could not read append location - ticket map will be rebuilt")
+                cached_thread_map = None
+    except Exception:
+        rollback_processed_marks(thread_state)
+        print(f"⚠️ Flush failed - rolled back this sync's processed marks")
+        raise
+
+    # Upsert only this sync's changes into the state db (fast, no API quota)
+    if dirty_thread_ids:
+        save_thread_state_to_db(thread_state, dirty_thread_ids)
+        dirty_thread_ids.clear()
+        _dirty_undo.clear()
+        print(f"💾 Saved thread state changes to db")
+
+    # All writes landed - now it is safe to commit the advanced cursors
+    if next_history_id != last_history_id:
+        last_history_id = next_history_id
+        save_history_id(last_history_id)
+    last_profile_history_id = profile_history_id
+
+    # Backup to sheet every N syncs
     if sync_counter % SHEET_BACKUP_INTERVAL == 0:
         save_thread_state_to_sheet(sheet, thread_state)
         save_last_sync_timestamp(sheet, int(time.time()))
         print(f"📊 Backed up thread state AND sync timestamp to sheet (sync #{sync_counter})")
     
-    # Check for stale tickets every 20 syncs (every ~100 seconds)
-    if sync_counter % 20 == 0:
-        check_and_close_stale_tickets(gmail, sheet, main_worksheet)
-    
     print("\n" + "="*50)
     print("✅ Sync complete!")
     print("="*50 + "\n")
+
+    # Thread count lets the caller back off its polling while idle
+    return len(threads)
@@ -23,41 +23,46 @@ def get_worksheet(sheet, worksheet_name):
 def get_all_tickets(worksheet):
     """
     Get all existing tickets from the sheet
-    Returns: dict mapping thread_id to row_number
+    Reads only the ticket-id and thread-id columns in one call
+    Returns: dict mapping thread_id to (row_number, ticket_id)
     """
-    rows = worksheet.get_all_values()
+    rows = worksheet.get_values("A2:B")
     thread_map = {}
-    
-    for i, row in enumerate(rows[1:], start=2):  # Skip header, start from row 2
-        if len(row) > 1 and row[1]:  # Check if thread_id exists
-            thread_map[row[1]] = i
-    
+
+    for i, row in enumerate(rows, start=2):  # Row 2 is the first data row
+        if len(row) > 1 and row[1]:
+            thread_map[row[1]] = (i, row[0])
+
     return thread_map
 
 
-def get_next_ticket_id(sheet):
+def allocate_ticket_ids(sheet, count):
     """
-    Generate next ticket ID
-    Reads from Ticket_Config sheet and increments counter
+    Reserve a block of ticket IDs in one counter read + one write
+    Replaces one read/write pair per new ticket
+    Returns: list of formatted ticket IDs
     """
+    if not count:
+        return []
+
     config_sheet = sheet.worksheet("Ticket_Config")
     last_ticket = int(config_sheet.acell("B1").value or 0)
-    next_ticket = last_ticket + 1
-    
-    # Update counter
-    config_sheet.update(range_name="B1", values=[[next_ticket]])
-    
-    return f"TCK-{next_ticket:06d}"
+
+    # Update counter once for the whole block
+    config_sheet.update(range_name="B1", values=[[last_ticket + count]])
+
+    return [f"TCK-{n:06d}" for n in range(last_ticket + 1, last_ticket + count + 1)]
 
 
 def create_ticket_row(ticket_id, thread_id, from_email, subject, status, new_sender=False):
     """
-    Create a ticket row for the spreadsheet
+    Create a ticket row for the spreadsheet (columns A:G)
+    The Open Mail link in column H is a sheet-side ARRAYFORMULA and is
+    never written per row
     Returns: list of values for the row
     """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    link = f'=HYPERLINK("https://mail.google.com/mail/u/0/#inbox/{thread_id}","Open Mail")'
-    
+
     return [
         ticket_id,
         thread_id,
@@ -66,24 +71,87 @@ def create_ticket_row(ticket_id, thread_id, from_email, subject, status, new_sen
         subject,
         status,
         "Yes" if new_sender else "No",  # Dynamic new sender detection
-        link,
     ]
 
 
-def add_new_ticket(worksheet, row_data):
-    """Add a new ticket row to the sheet"""
-    worksheet.append_row(row_data, value_input_option="USER_ENTERED")
+def append_tickets(worksheet, rows):
+    """
+    Append multiple ticket rows in a single API call
+    table_range pins append's table detection to the ticket columns A:G -
+    the column-H ARRAYFORMULA fills the grid with empty strings that would
+    otherwise count as occupied and push appends below them
+    Returns: the API response (updates.updatedRange says where rows landed)
+    """
+    if rows:
+        return worksheet.append_rows(
+            rows, value_input_option="USER_ENTERED", table_range="A1:G1"
+        )
+
+
+def batch_update_tickets(worksheet, updates):
+    """
+    Apply multiple row updates in a single values.batchUpdate call
+    updates: list of {"range": ..., "values": [...]} dicts
+    """
+    if updates:
+        worksheet.batch_update(updates, value_input_option="USER_ENTERED")
+
+
+def delete_rows_batch(sheet, worksheet, row_numbers):
+    """
+    Delete multiple rows in a single batchUpdate call
+    Rows are removed in descending order so indices stay stable
+    """
+    if not row_numbers:
+        return
+
+    requests = [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": worksheet.id,
+                    "dimension": "ROWS",
+                    "startIndex": row - 1,
+                    "endIndex": row,
+                }
+            }
+        }
+        for row in sorted(row_numbers, reverse=True)
+    ]
+    sheet.batch_update({"requests": requests})
+
+
+def batch_get_ranges(sheet, ranges):
+    """
+    Fetch multiple ranges from the spreadsheet in one API call
+    Returns: list of value lists, one per requested range
+    """
+    response = sheet.values_batch_get(ranges)
+    return [vr.get("values", []) for vr in response.get("valueRanges", [])]
 
 
-def update_existing_ticket(worksheet, row_number, row_data):
-    """Update an existing ticket row"""
-    range_name = f"A{row_number}:H{row_number}"
-    worksheet.update(range_name, [row_data], value_input_option="USER_ENTERED")
+# The Open Mail link lives in one ARRAYFORMULA instead of a per-row constant
+LINK_FORMULA = (
+    '=ARRAYFORMULA(IF(B2:B="","",'
+    'HYPERLINK("https://mail.google.com/mail/u/0/#inbox/"&B2:B,"Open Mail")))'
+)
 
 
-def get_ticket_data(worksheet, row_number):
-    """Get ticket data from a specific row"""
-    return worksheet.row_values(row_number)
+def ensure_link_formula(worksheet):
+    """
+    Make sure the Open Mail column (H) is driven by the ARRAYFORMULA
+    so ticket rows never need to include the hyperlink themselves
+    """
+    try:
+        current = worksheet.acell("H2", value_render_option="FORMULA").value
+        if current != LINK_FORMULA:
+            # Legacy per-row HYPERLINK formulas below H2 would stop the
+            # ARRAYFORMULA from expanding (#REF!) - clear them first
+            worksheet.batch_clear(["H3:H"])
+            worksheet.update("H2", [[LINK_FORMULA]], value_input_option="USER_ENTERED")
+            print("✅ Installed Open Mail link formula in column H")
+    except Exception as e:
+        print(f"⚠️ Could not install link formula: {e}")
 
 
 # ================= SYNC STATE MANAGEMENT =================